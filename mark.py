@@ -19,8 +19,10 @@
 
 import os
 import sys
+import threading
 
 from gettext import gettext as _
+from gi.repository import GLib
 from plugins.plugin import Plugin
 
 from TurtleArt.tapalette import make_palette
@@ -45,6 +47,19 @@ ERROR_VALUE_S = _('ERROR: Value must be an integer from 0 to 180')
 ERROR_SPEED = _('ERROR: The speed must be a number from 0 to 100')
 ERROR_PIN_TYPE = _('ERROR: The pin must be an integer')
 
+# Analog reporting is left on and a cached value newer than this (in
+# seconds) is returned at once. None enables and disables reporting on
+# each read
+ANALOG_MAX_AGE = 0.1
+# Longest wait (in seconds) for a new analog value
+ANALOG_WAIT_TIME = 0.05
+# Sonars keep measuring once configured, a distance newer than this (in
+# seconds) is returned at once
+SONAR_MAX_AGE = 0.1
+# Longest wait (in seconds) for a new distance, a bit more than the default
+# ping interval of the sonar
+SONAR_WAIT_TIME = 0.1
+
 COLOR_NOTPRESENT = ["#A0A0A0","#808080"]
 COLOR_PRESENT = ["#FF0000", "#A06060"]
 
@@ -56,7 +71,13 @@ class Mark(Plugin):
         self.tw = parent
         self.active_mark = 0
         self._marks = []
-        self._marks_it = []
+        self._io_loop = None
+        self._serial_watcher = None
+        # serial ports being connected, see _claim_port
+        self._connecting = set()
+        self._connecting_lock = threading.Lock()
+        self.analog_max_age = ANALOG_MAX_AGE
+        self.sonar_max_age = SONAR_MAX_AGE
 
     def setup(self):
         """ Setup is called once, when the Turtle Window is created. """
@@ -203,12 +224,21 @@ class Mark(Plugin):
     ############################### Turtle signals ############################
 
     def quit(self):
+        if self._serial_watcher is not None:
+            self._serial_watcher.stop()
+            self._serial_watcher = None
         self._close_marks()
+        if self._io_loop is not None:
+            self._io_loop.stop()
+            self._io_loop = None
 
     def stop(self):
         try:
-            self.markTurnMotorA(0)
-            self.markTurnMotorB(0)
+            a = self._marks[self.active_mark]
+            # halt both motors in the same write
+            with a.batch():
+                self.markTurnMotorA(0)
+                self.markTurnMotorB(0)
         except:
             pass
         #self.resetBoards()
@@ -250,19 +280,17 @@ class Mark(Plugin):
             raise logoerror(ERROR_PIN_TYPE)
         res = -1
         try:
-            res = self.analogRead(pin)
+            res = self.analogRead(pin, gray=True)
         except:
             pass
-        if not(res == -1) and not(res == None):
-            return int(res * 100)
         return res
 
-    def _convert_pin(self, pin):
+    def _convert_pin(self, a, pin):
         """
         Convert analog pin to digital equivalent
         """
-        if pin < 6:
-            return pin + 14
+        if pin < len(a.analog_pins):
+            return a.analog_pins[pin]
         else:
             return pin
 
@@ -274,14 +302,11 @@ class Mark(Plugin):
         res = -1
         try:
             a = self._marks[self.active_mark]
-            digital_pin = self._convert_pin(pin)
-
+            digital_pin = self._convert_pin(a, pin)
+            # only configured the first time, then it keeps measuring
             a.sonar_config(digital_pin)
-            
-            a.sonar[digital_pin].enable_reporting()
-            a.pass_time(0.05)
-            res = a.sonar[digital_pin].read()
-            a.sonar[pin].disable_reporting()
+            res = self._cached_read(a.sonar[digital_pin], self.sonar_max_age,
+                                    SONAR_WAIT_TIME)
         except:
             pass
         if res:
@@ -309,8 +334,9 @@ class Mark(Plugin):
         try:
             a = self._marks[self.active_mark]
             new_mode = MODE['OUTPUT']
-            a.digital[pin]._set_mode(new_mode)
-            a.digital[pin].write(on_off)
+            with a.batch():
+                a.digital[pin]._set_mode(new_mode)
+                a.digital[pin].write(on_off)
         except:
             pass
 
@@ -329,18 +355,20 @@ class Mark(Plugin):
         power = power / 100.0
         try:
             a = self._marks[self.active_mark]
-            # check mode pwm and set the power
-            actual_mode = a.digital[pin_p]._get_mode()
-            new_mode = MODE['PWM']
-            if not(actual_mode == new_mode):
-                a.digital[pin_p]._set_mode(new_mode)
-            a.digital[pin_p].write(power)
-            # check mode output and set the sense
-            actual_mode = a.digital[pin_s]._get_mode()
-            new_mode = MODE['OUTPUT']
-            if not(actual_mode == new_mode):
-                a.digital[pin_s]._set_mode(new_mode)
-            a.digital[pin_s].write(sense)
+            # send the power and the sense in a single write
+            with a.batch():
+                # check mode pwm and set the power
+                actual_mode = a.digital[pin_p]._get_mode()
+                new_mode = MODE['PWM']
+                if not(actual_mode == new_mode):
+                    a.digital[pin_p]._set_mode(new_mode)
+                a.digital[pin_p].write(power)
+                # check mode output and set the sense
+                actual_mode = a.digital[pin_s]._get_mode()
+                new_mode = MODE['OUTPUT']
+                if not(actual_mode == new_mode):
+                    a.digital[pin_s]._set_mode(new_mode)
+                a.digital[pin_s].write(sense)
         except:
             raise logoerror(ERROR)
 
@@ -357,15 +385,19 @@ class Mark(Plugin):
             raise logoerror(ERROR_VALUE_S)
         try:
             a = self._marks[self.active_mark]
-            actual_mode = a.digital[pin]._get_mode()
-            new_mode = MODE['SERVO']
-            if not(actual_mode == new_mode):
-                a.digital[pin]._set_mode(new_mode)
-            a.digital[pin].write(angle)
+            with a.batch():
+                actual_mode = a.digital[pin]._get_mode()
+                new_mode = MODE['SERVO']
+                if not(actual_mode == new_mode):
+                    a.digital[pin]._set_mode(new_mode)
+                a.digital[pin].write(angle)
         except:
             raise logoerror(ERROR)
 
-    def analogRead(self, pin):
+    def analogRead(self, pin, gray=False):
+        """
+        Read an analog pin, from 0.0 to 1.0 or in the 0-100 gray scale.
+        """
         try:
             pin = int(pin)
         except:
@@ -373,14 +405,37 @@ class Mark(Plugin):
         res = -1
         try:
             a = self._marks[self.active_mark]
-            a.analog[pin].enable_reporting()
-            a.pass_time(0.05)
-            res = a.analog[pin].read()
-            a.analog[pin].disable_reporting()
+            p = a.analog[pin]
+            if self.analog_max_age is None:
+                p.enable_reporting()
+                p.wait_for_update(ANALOG_WAIT_TIME)
+                p.disable_reporting()
+            else:
+                self._cached_read(p, self.analog_max_age, ANALOG_WAIT_TIME)
+            if gray:
+                res = p.read_gray()
+            else:
+                res = p.read()
         except:
             pass
         return res
 
+    def _cached_read(self, p, max_age, wait_time):
+        """
+        Read a reporting pin, waiting up to wait_time for a new value only if
+        the last one is older than max_age.
+        """
+        if not p.reporting:
+            p.enable_reporting()
+            # more reports, keep them within the bandwidth of the link and
+            # only as fast as needed for max_age
+            min_interval = markrobot.DEFAULT_SAMPLING_INTERVAL
+            if max_age is not None:
+                min_interval = max(min_interval, int(max_age * 1000 / 2))
+            p.board.auto_sampling_interval(min_interval=min_interval)
+        p.wait_for_update(wait_time, max_age)
+        return p.read()
+
     def select(self, i):
         n = len(self._marks)
         try:
@@ -432,29 +487,37 @@ class Mark(Plugin):
             raise logoerror(_('The name must be a string'))
 
         self._close_marks()
-        
-        output = markrobot.find_blue_marks(name=name)
-        if len(output) > 0:
-            dev = output[0]
-            try:
-                board = dev.connect()
-                it = markrobot.util.Iterator(board)
-                it.start()
-                self._marks.append(board)
-                self._marks_it.append(it)
-            except:
-                pass
+
+        # try the address it had the last time before a slow inquiry
+        for find in (markrobot.cached_blue_marks, markrobot.find_blue_marks):
+            output = find(name=name)
+            if len(output) > 0:
+                dev = output[0]
+                try:
+                    board = dev.connect()
+                    self._add_mark(board)
+                    break
+                except:
+                    pass
 
         self.change_color_blocks()
 
         if len(self._marks) == 0:
             raise logoerror(_('Not found mark %s') % name)
 
+    def _health_changed(self, board, state):
+        # called from the IOLoop thread, update the blocks in the GTK one
+        GLib.idle_add(self.change_color_blocks)
+
+    def _mark_connected(self, board):
+        health = self._io_loop.get_health(board)
+        return not(health == markrobot.LINK_DISCONNECTED)
+
     def change_color_blocks(self):
-        if len(self._marks) > 0:
-            mark_present = True
-        else:
-            mark_present = False
+        mark_present = False
+        for board in self._marks:
+            if self._mark_connected(board):
+                mark_present = True
         index = palette_name_to_index('mark')
         if index is not None:
             mark_blocks = palette_blocks[index]
@@ -468,37 +531,146 @@ class Mark(Plugin):
                         block.refresh()
             self.tw.regenerate_palette(index)
 
-    def _close_marks(self):
-        for it in self._marks_it:
+    def _add_mark(self, board):
+        # all the boards are read by a single thread
+        if self._io_loop is None:
+            self._io_loop = markrobot.util.IOLoop(self._health_changed)
+            self._io_loop.start()
+        if os.path.exists(markrobot.CALIBRATION_FILE):
             try:
-                it.stop()
+                board.load_analog_calibration()
             except:
                 pass
+        self._io_loop.add(board)
+        self._marks.append(board)
+
+    def _close_marks(self):
         for dev in self._marks:
+            try:
+                self._io_loop.remove(dev)
+            except:
+                pass
             try:
                 dev.exit()
             except:
                 pass
         self._marks = []
-        self._marks_it = []
 
-    def refresh(self):
-        self._close_marks()
-
-        marks1 = markrobot.serialsock.find_serial_marks()
-        marks2 = markrobot.bluesock.find_blue_marks()
-        output = marks1
-        output.extend(marks2)
-
-        for dev in output:
+    def _claim_port(self, name):
+        """
+        Mark a serial port as being connected, so refresh and the
+        SerialWatcher never open it at the same time. Returns False if it
+        already is.
+        """
+        with self._connecting_lock:
+            if name in self._connecting:
+                return False
+            self._connecting.add(name)
+            return True
+
+    def _release_port(self, name):
+        with self._connecting_lock:
+            self._connecting.discard(name)
+
+    def _serial_changed(self, event, device):
+        # called from the SerialWatcher thread, only the boards plugged or
+        # unplugged are touched so the others keep running
+        if event == markrobot.SERIAL_REMOVED:
+            GLib.idle_add(self._remove_mark, device)
+            return
+        for dev in markrobot.serialsock.find_serial_marks(name=device):
+            if not self._claim_port(dev.name):
+                continue
+            if dev.name in [m.get_name() for m in list(self._marks)]:
+                self._release_port(dev.name)
+                continue
             try:
                 board = dev.connect()
-                it = markrobot.util.Iterator(board)
-                it.start()
-                self._marks.append(board)
-                self._marks_it.append(it)
             except:
-                pass
+                self._release_port(dev.name)
+                continue
+            # the port is released once the board is in self._marks
+            GLib.idle_add(self._plugged_mark, board)
+
+    def _plugged_mark(self, board):
+        try:
+            for m in self._marks:
+                if m.get_name() == board.get_name():
+                    board.exit()
+                    return False
+            self._add_mark(board)
+        finally:
+            self._release_port(board.get_name())
+        self.change_color_blocks()
+        return False
+
+    def _remove_mark(self, name):
+        for i, board in enumerate(self._marks):
+            if board.get_name() == name:
+                break
+        else:
+            return False
+        del self._marks[i]
+        # keep the same board selected
+        if self.active_mark > i:
+            self.active_mark -= 1
+        try:
+            self._io_loop.remove(board)
+        except:
+            pass
+        try:
+            board.exit()
+        except:
+            pass
+        self.change_color_blocks()
+        return False
+
+    def refresh(self):
+        # the serial boards keep running while the port is closed, take them
+        # over again instead of resetting them
+        snapshots = {}
+        for board in self._marks:
+            if board.sock.type == 'serial':
+                try:
+                    snapshots[board.get_name()] = board.snapshot()
+                except:
+                    pass
+        self._close_marks()
+
+        # watch before looking for the boards, so none plugged in meanwhile
+        # is missed
+        if self._serial_watcher is None:
+            self._serial_watcher = markrobot.SerialWatcher(
+                self._serial_changed)
+            self._serial_watcher.start()
+
+        claimed = []
+
+        def connect(dev):
+            if dev.type == 'serial':
+                # the SerialWatcher may be connecting it
+                if not self._claim_port(dev.name):
+                    raise IOError('%s is already being connected' % dev.name)
+                claimed.append(dev.name)
+            if dev.name in snapshots:
+                try:
+                    return dev.reconnect(snapshots[dev.name])
+                except:
+                    # it was reset or replaced, start from scratch
+                    pass
+            return dev.connect()
+
+        # look for the serial and Bluetooth boards and connect to them all
+        # at the same time
+        try:
+            for dev, board in markrobot.discovery.connect_marks(connect):
+                try:
+                    self._add_mark(board)
+                except:
+                    pass
+        finally:
+            for name in claimed:
+                self._release_port(name)
 
         self.change_color_blocks()
 
@@ -3,3 +3,4 @@ from .mark import *
 from .util import *
 from .bluesock import *
 from .serialsock import *
+from .discovery import *
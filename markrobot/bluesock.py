@@ -4,37 +4,75 @@ try:
 except:
     pass
 
+import socket
+import threading
+import time
+
 from .mark import MarkRobot
+from .util import READ_CHUNK_SIZE, CONNECT_TIMEOUT, BLUETOOTH_CACHE_FILE, \
+    BLUETOOTH_CACHE_TTL, read_json, write_json
+
+# Bytes per second of the link, limited by the 57600 baud serial port
+# between the Bluetooth module and the board
+BLUETOOTH_BANDWIDTH = 5760.0
 
 class BlueSock(object):
 
     def __init__(self, host, name=None):
         self.host = host
+        self.address = host
         self.name = name
         self.sock = None
         self.type = 'bluetooth'
+        self.resets_on_connect = False
+        self.bandwidth = BLUETOOTH_BANDWIDTH
 
-    def connect(self):
+    def connect(self, timeout=CONNECT_TIMEOUT):
         self.sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-        self.sock.connect((self.host, 1))
+        # a board that is off or out of range doesn't refuse the connection,
+        # the page just goes on
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect((self.host, 1))
+        except:
+            self.close()
+            raise
         #self.sock.setblocking(1)
         self.sock.settimeout(1)
-        return MarkRobot(self)
+        try:
+            board = MarkRobot(self)
+        except:
+            self.close()
+            raise
+        remember_blue_marks([self])
+        return board
 
     def close(self):
-        self.sock.close()
-        self.sock = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
 
     def inWaiting(self):
+        # RFCOMM can't tell how many bytes are pending, recv returns
+        # whatever has arrived up to this size
         if self.sock:
-            return True
-        return False
+            return READ_CHUNK_SIZE
+        return 0
 
     def write(self, data):
         self.sock.send(data)
 
-    def read(self):
-        return self.sock.recv(1)
+    def read(self, size=1):
+        try:
+            return self.sock.recv(size)
+        except bluetooth.BluetoothError as e:
+            # PyBluez wraps the timeouts of the socket
+            if 'timed out' in str(e):
+                raise socket.timeout(str(e))
+            raise
+
+    def fileno(self):
+        return self.sock.fileno()
 
 def _check_mark(arg, value):
     return arg is None or arg == value
@@ -49,3 +87,40 @@ def find_blue_marks(host=None, name=None):
         pass
     return ret
 
+# The cache is read and written by the threads connecting the boards
+_cache_lock = threading.Lock()
+
+def remember_blue_marks(devices):
+    """
+    Save the address of the devices, by name, in BLUETOOTH_CACHE_FILE with
+    the time they were seen. Only boards that were connected are saved, not
+    everything an inquiry finds.
+    """
+    if not devices:
+        return
+    with _cache_lock:
+        cache = read_json(BLUETOOTH_CACHE_FILE, {})
+        for dev in devices:
+            if dev.name:
+                cache[dev.name] = (dev.host, time.time())
+        try:
+            write_json(BLUETOOTH_CACHE_FILE, cache)
+        except (IOError, OSError):
+            pass
+
+def cached_blue_marks(host=None, name=None, ttl=BLUETOOTH_CACHE_TTL):
+    """
+    Like find_blue_marks, but returns the devices seen in the last ``ttl``
+    seconds without an inquiry.
+    """
+    with _cache_lock:
+        cache = read_json(BLUETOOTH_CACHE_FILE, {})
+    if name is not None:
+        cache = {name: cache[name]} if name in cache else {}
+    ret = []
+    oldest = time.time() - ttl
+    for n, (h, last_seen) in cache.items():
+        if last_seen >= oldest and _check_mark(host, h):
+            ret.append(BlueSock(h, n))
+    return ret
+
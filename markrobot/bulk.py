@@ -0,0 +1,83 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .util import ANALOG_MESSAGE, ANALOG_MAX_RAW, START_SYSEX, END_SYSEX, \
+    SONAR_DATA
+
+
+# Smallest receive buffer (in bytes) that is worth decoding with NumPy
+BULK_DECODE_MIN_SIZE = 96
+
+if numpy is not None:
+    FRAME_DTYPE = numpy.dtype([('pin', numpy.uint8), ('raw', numpy.uint16),
+                               ('scaled', numpy.float64),
+                               ('timestamp', numpy.float64)])
+
+
+def _frames(pins, raws, scaled, timestamp):
+    frames = numpy.empty(len(pins), dtype=FRAME_DTYPE)
+    frames['pin'] = pins
+    frames['raw'] = raws
+    frames['scaled'] = scaled
+    frames['timestamp'] = timestamp
+    return frames
+
+
+def decode_bulk(buf, timestamp, analog_table=None):
+    """
+    Decode at once all the complete ANALOG_MESSAGE and SONAR_DATA frames of
+    a receive buffer. NumPy is required.
+
+    Returns a tuple (analog, sonar, rest). ``analog`` and ``sonar`` are
+    arrays of FRAME_DTYPE (pin, raw, scaled, timestamp) in arrival order,
+    the analog values scaled from 0.0 to 1.0 and the sonar ones left as
+    distances. ``rest`` is a bytearray with the bytes of all the other
+    frames, including an incomplete one at the end, to decode as usual.
+
+    ``analog_table`` has a row with the scale of each analog pin, indexed by
+    the raw value (see :class:`AnalogScale`). The analog values of pins
+    without a row are 0.0. By default they are raw / 1023.
+
+    Removing those frames doesn't break the others: they start with a
+    command byte and their payload bytes never have the high bit set.
+    """
+    data = numpy.frombuffer(bytes(buf), dtype=numpy.uint8)
+    size = len(data)
+    is_data = data < 0x80
+
+    # ANALOG_MESSAGE: command with the pin in the low nibble, lsb, msb
+    analog = numpy.flatnonzero((data[:max(size - 2, 0)] & 0xF0) ==
+                               ANALOG_MESSAGE)
+    analog = analog[is_data[analog + 1] & is_data[analog + 2]]
+
+    # SONAR_DATA: START_SYSEX, SONAR_DATA, pin, lsb, msb, END_SYSEX
+    sonar = numpy.flatnonzero(data[:max(size - 5, 0)] == START_SYSEX)
+    sonar = sonar[(data[sonar + 1] == SONAR_DATA) &
+                  (data[sonar + 5] == END_SYSEX) & is_data[sonar + 2] &
+                  is_data[sonar + 3] & is_data[sonar + 4]]
+
+    keep = numpy.ones(size, dtype=bool)
+    for i in range(3):
+        keep[analog + i] = False
+    for i in range(6):
+        keep[sonar + i] = False
+
+    pins = data[analog] & 0x0F
+    raws = data[analog + 1].astype(numpy.uint16)
+    raws |= data[analog + 2].astype(numpy.uint16) << 7
+    raws = numpy.minimum(raws, ANALOG_MAX_RAW)
+    if analog_table is None:
+        scaled = numpy.round(raws / float(ANALOG_MAX_RAW), 4)
+    else:
+        scaled = numpy.zeros(len(raws))
+        known = pins < len(analog_table)
+        scaled[known] = analog_table[pins[known], raws[known]]
+    analog_frames = _frames(pins, raws, scaled, timestamp)
+
+    raws = data[sonar + 3].astype(numpy.uint16)
+    raws |= data[sonar + 4].astype(numpy.uint16) << 7
+    sonar_frames = _frames(data[sonar + 2], raws, raws, timestamp)
+
+    return analog_frames, sonar_frames, bytearray(data[keep].tobytes())
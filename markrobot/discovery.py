@@ -0,0 +1,306 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import os
+import selectors
+import struct
+import threading
+import time
+from concurrent import futures
+
+from .util import CONNECT_TIMEOUT, CONNECT_WORKERS, SERIAL_ADDED, \
+    SERIAL_REMOVED, SERIAL_DEVICE_PATTERNS, SERIAL_WATCH_INTERVAL, \
+    SERIAL_SETTLE_TIME
+from .serialsock import find_serial_marks
+from .bluesock import find_blue_marks, cached_blue_marks
+
+
+class ConnectPool(object):
+    """
+    Connect to many devices at the same time with ``workers`` threads.
+
+    Each device has ``timeout`` seconds from the moment a thread starts
+    connecting it. A device that takes longer is cancelled by closing it,
+    which makes its pending read, write or connect fail, so a board that
+    doesn't answer only holds its own thread.
+
+    A device is connected once even if it is submitted again, unless the
+    first try failed.
+
+    :arg connect: Function that connects a device and returns its board,
+        by default ``dev.connect()``.
+    """
+    def __init__(self, connect=None, timeout=CONNECT_TIMEOUT,
+                 workers=CONNECT_WORKERS):
+        self.connect = connect or (lambda dev: dev.connect())
+        self.timeout = timeout
+        self._pool = futures.ThreadPoolExecutor(workers)
+        self._lock = threading.Lock()
+        self._futures = []
+        self._by_address = {}
+        self._started = {}
+        self._finished = set()
+        self._cancelled = set()
+
+    def submit(self, dev):
+        """
+        Start connecting ``dev`` as soon as a thread is free. Returns False
+        if a device with the same address is connecting or connected.
+        """
+        previous = self._by_address.get(dev.address)
+        if previous is not None:
+            if not(previous.done()) or previous.exception() is None:
+                return False
+        f = self._pool.submit(self._connect, dev)
+        self._by_address[dev.address] = f
+        self._futures.append((dev, f))
+        return True
+
+    def _connect(self, dev):
+        with self._lock:
+            self._started[dev] = time.monotonic()
+        try:
+            board = self.connect(dev)
+        finally:
+            with self._lock:
+                self._finished.add(dev)
+                cancelled = dev in self._cancelled
+        if cancelled:
+            # it made it after all, but too late
+            board.exit()
+            raise IOError('%s timed out' % dev.name)
+        return board
+
+    def _cancel_late(self):
+        """
+        Close the devices that ran out of time. Returns the seconds until the
+        next one does, None if no device is connecting.
+        """
+        now = time.monotonic()
+        wait = None
+        with self._lock:
+            for dev, started in self._started.items():
+                if (dev in self._finished) or (dev in self._cancelled):
+                    continue
+                left = started + self.timeout - now
+                if left <= 0:
+                    self._cancelled.add(dev)
+                    try:
+                        dev.close()
+                    except:
+                        pass
+                elif (wait is None) or (left < wait):
+                    wait = left
+        return wait
+
+    def join(self):
+        """
+        Wait for all the devices and return a list of (dev, board) with the
+        ones connected, in the order they were submitted.
+        """
+        pending = set(f for dev, f in self._futures)
+        while pending:
+            wait = self._cancel_late()
+            if wait is None:
+                # devices waiting for a thread, check again soon
+                wait = 0.1
+            done, pending = futures.wait(pending, wait,
+                                         futures.FIRST_COMPLETED)
+        self._pool.shutdown(wait=False)
+        ret = []
+        for dev, f in self._futures:
+            if f.exception() is None:
+                ret.append((dev, f.result()))
+        return ret
+
+
+# The Bluetooth boards in the cache are connected during the inquiry
+FINDERS = (find_serial_marks, cached_blue_marks, find_blue_marks)
+
+
+def connect_marks(connect=None, timeout=CONNECT_TIMEOUT,
+                  workers=CONNECT_WORKERS, finders=FINDERS):
+    """
+    Find the boards and connect to them, see :class:`ConnectPool`. The
+    devices of each finder are connected as soon as it returns, while the
+    others are still looking. A device found by several finders is
+    connected once. Returns a list of (dev, board), in the order of the
+    finders.
+    """
+    pool = ConnectPool(connect, timeout, workers)
+    devices = {}
+    with futures.ThreadPoolExecutor(len(finders)) as finders_pool:
+        found = [finders_pool.submit(finder) for finder in finders]
+        for f in futures.as_completed(found):
+            try:
+                devices[f] = f.result()
+            except:
+                continue
+            for dev in devices[f]:
+                pool.submit(dev)
+    order = []
+    for f in found:
+        order.extend(devices.get(f, []))
+    return sorted(pool.join(), key=lambda item: order.index(item[0]))
+
+
+# inotify flags, from <sys/inotify.h>
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_EVENT = struct.Struct('iIII')
+
+
+def _inotify_watch(path, mask):
+    """
+    Returns a non-blocking inotify file descriptor watching ``path``, None if
+    inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, path.encode(), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class SerialWatcher(threading.Thread):
+    """
+    Report the serial ports plugged and unplugged. ``callback`` is called
+    from this thread with SERIAL_ADDED or SERIAL_REMOVED and the path of the
+    device node. The ports present when it starts are not reported.
+
+    The directory of the nodes is watched with inotify, or scanned every ``interval`` seconds if
+    that is not available. A new port is reported SERIAL_SETTLE_TIME
+    seconds after it appears, if it is still there.
+    """
+    def __init__(self, callback, patterns=SERIAL_DEVICE_PATTERNS,
+                 interval=SERIAL_WATCH_INTERVAL):
+        super(SerialWatcher, self).__init__()
+        self.daemon = True
+        self.callback = callback
+        self.patterns = patterns
+        self.interval = interval
+        # all the patterns are in the same directory
+        self.directory = os.path.dirname(patterns[0])
+        # watch before the first scan not to miss a port plugged in between
+        self._fd = _inotify_watch(self.directory, IN_CREATE | IN_DELETE |
+                                  IN_MOVED_FROM | IN_MOVED_TO)
+        self.devices = self._scan()
+        # devices found but not reported yet, with the time to do it
+        self._settling = {}
+        self._execute = True
+        self._wake_r, self._wake_w = os.pipe()
+
+    def _scan(self):
+        devices = set()
+        for pattern in self.patterns:
+            devices.update(glob.glob(pattern))
+        return devices
+
+    def _matches(self, path):
+        for pattern in self.patterns:
+            if fnmatch.fnmatch(path, pattern):
+                return True
+        return False
+
+    def _read_events(self, fd):
+        """Returns the nodes added and removed from the inotify events."""
+        added = set()
+        removed = set()
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return added, removed
+        i = 0
+        while i < len(data):
+            wd, mask, cookie, size = IN_EVENT.unpack_from(data, i)
+            i += IN_EVENT.size
+            name = data[i:i + size].rstrip(b'\0').decode()
+            i += size
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, compare with what is there now
+                devices = self._scan()
+                added.update(devices - self.devices)
+                removed.update(self.devices - devices)
+                continue
+            path = os.path.join(self.directory, name)
+            if not self._matches(path):
+                continue
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                added.add(path)
+                removed.discard(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                removed.add(path)
+                added.discard(path)
+        return added, removed
+
+    def _changed(self, added, removed):
+        now = time.monotonic()
+        for path in added:
+            if path not in self.devices:
+                self._settling.setdefault(path, now + SERIAL_SETTLE_TIME)
+        for path in removed:
+            self._settling.pop(path, None)
+            if path in self.devices:
+                self.devices.discard(path)
+                self._notify(SERIAL_REMOVED, path)
+        for path, due in list(self._settling.items()):
+            if due <= now:
+                del self._settling[path]
+                if os.path.exists(path):
+                    self.devices.add(path)
+                    self._notify(SERIAL_ADDED, path)
+
+    def _notify(self, event, path):
+        try:
+            self.callback(event, path)
+        except:
+            pass
+
+    def _timeout(self):
+        """Seconds until the next scan or settled device."""
+        timeout = None if self._fd is not None else self.interval
+        if self._settling:
+            left = max(min(self._settling.values()) - time.monotonic(), 0)
+            if timeout is None or left < timeout:
+                timeout = left
+        return timeout
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wake_r, selectors.EVENT_READ)
+        if self._fd is not None:
+            selector.register(self._fd, selectors.EVENT_READ)
+        while self._execute:
+            ready = [key.fd for key, events in selector.select(self._timeout())]
+            if not self._execute:
+                break
+            if self._fd is None:
+                devices = self._scan()
+                added, removed = devices - self.devices, self.devices - devices
+            elif self._fd in ready:
+                added, removed = self._read_events(self._fd)
+            else:
+                added, removed = set(), set()
+            self._changed(added, removed)
+        selector.close()
+        if self._fd is not None:
+            os.close(self._fd)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def stop(self):
+        self._execute = False
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass
@@ -1,24 +1,47 @@
 
+import contextlib
 import inspect
+import json
+import math
+import re
+import select
+import socket
 import time
 import itertools
 from .util import *
+from .bulk import numpy, decode_bulk, BULK_DECODE_MIN_SIZE
 
 
+# A byte with the high bit set, which starts (or ends) a message
+COMMAND_BYTE = re.compile(b'[\x80-\xff]')
+
 
 class MarkRobot(object):
     """The Base class for any board."""
-    firmata_version = None
-    firmware = None
-    firmware_version = None
-    _command_handlers = {}
-    _command = None
-    _stored_data = []
-    _parsing_sysex = False
-
-    def __init__(self, sock):
+
+    def __init__(self, sock, layout=None):
+        # All the state lives in the instance so several boards can be
+        # connected at the same time without sharing handlers or data
         self.sock = sock
-        self.setup_layout()
+        self.firmata_version = None
+        self.firmware = None
+        self.firmware_version = None
+        self.sampling_interval = DEFAULT_SAMPLING_INTERVAL
+        self._rx_buffer = bytearray()
+        self._tx_buffer = bytearray()
+        self._batch_depth = 0
+        # Scale of the analog pins, unless they have their own calibration
+        self.analog_scale = AnalogScale()
+        self._calibrations = {}
+        self._analog_table = None
+        self._capabilities = None
+        self._analog_mapping = None
+        self._setup_handlers()
+        self.setup_layout(layout)
+        if not self.handshake():
+            raise IOError("%s did not answer" % self.get_name())
+        if layout is None:
+            self.probe_layout()
 
     def __del__(self):
         """
@@ -29,37 +52,67 @@ class MarkRobot(object):
         self.exit()
 
     def send_as_two_bytes(self, val):
-        self.sock.write(chr(val % 128) + chr(val >> 7))
+        self._write((val % 128, val >> 7))
 
-    def setup_layout(self):
+    def _write(self, frame):
         """
-        Setup the Pin instances based on the given board layout. Maybe it will
-        be possible to do this automatically in the future, by polling the
-        board for its type.
+        Queue the bytes of a frame and send them, unless a :meth:`batch` is
+        in progress.
         """
-        layout = {
-        'digital' : tuple(x for x in range(14)),
-        'analog' : tuple(x for x in range(6)),
-        'pwm' : (3, 5, 6, 9, 10, 11),
-        'use_ports' : True,
-        'disabled' : (0, 1) # Rx, Tx, Crystal
-        }
+        self._tx_buffer.extend(frame)
+        if not self._batch_depth:
+            self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Queue all the frames written inside the ``with`` block and send them
+        together in a single write when it ends. Batches can be nested, only
+        the outermost one sends the data.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.flush()
+
+    def flush(self):
+        """Send all the queued bytes with a single write."""
+        if self._tx_buffer:
+            self.sock.write(bytes(self._tx_buffer))
+            del self._tx_buffer[:]
+
+    def setup_layout(self, layout=None):
+        """
+        Setup the Pin instances based on the given board layout, by default
+        the one of an Arduino Uno (see :meth:`probe_layout`).
+        """
+        if layout is None:
+            layout = DEFAULT_LAYOUT
+        self.layout = layout
+        # Digital pin number of each analog channel
+        self.analog_pins = list(layout['analog_pins'])
 
         # Create pin instances based on board layout
         self.analog = []
         for i in layout['analog']:
             self.analog.append(Pin(self, i))
+            self.analog[-1].scale = self._calibrations.get(i, self.analog_scale)
+        self._analog_table = None
 
-        # Create pin instances for sonar
+        # Create pin instances for sonar, any pin can be one
         self.sonar = []
-        for i in range(20):
-            self.sonar.append(Pin(self, i))
+        for i in range(max(len(layout['digital']),
+                           max(self.analog_pins or [0]) + 1)):
+            self.sonar.append(Pin(self, i, type=SONAR))
 
         self.digital = []
         self.digital_ports = []
-        for i in xrange(0, len(layout['digital']), 8):
+        for i in range(0, len(layout['digital']), 8):
             num_pins = len(layout['digital'][i:i+8])
-            port_number = i / 8
+            port_number = i // 8
             self.digital_ports.append(Port(self, port_number, num_pins))
 
         # Allow to access the Pin instances directly
@@ -74,30 +127,166 @@ class MarkRobot(object):
         for i in layout['disabled']:
             self.digital[i].mode = UNAVAILABLE
 
+    def handshake(self, timeout=BOARD_SETUP_WAIT_TIME):
+        """
+        Wait until the firmware runs, so that no command is lost. The
+        firmware reports its version when it boots, which happens when the
+        serial port is opened. Boards that are not reset by the connection
+        (``sock.resets_on_connect`` is False) are asked for it at once, the
+        others after BOARD_BOOT_TIME. Returns True if the board answered.
+        """
+        has_version = lambda: self.firmata_version is not None
+        if getattr(self.sock, 'resets_on_connect', False):
+            boot_time = min(BOARD_BOOT_TIME, timeout)
+            if self._wait_for(has_version, boot_time):
+                return True
+            timeout -= boot_time
+        self.send_report_version()
+        return self._wait_for(has_version, timeout)
+
+    def send_report_version(self):
+        """Ask the firmware to report its version."""
+        self._write((REPORT_VERSION,))
+
+    def probe_layout(self, timeout=LAYOUT_QUERY_TIMEOUT):
+        """
+        Ask the board for its pins with CAPABILITY_QUERY and
+        ANALOG_MAPPING_QUERY and setup the layout. The layout is cached on
+        disk by firmware and version, so the next time it is not asked.
+        Keeps the current layout if the board doesn't answer.
+        """
+        if self.firmware is None:
+            self.getFirmware()
+            if not self._wait_for(lambda: self.firmware is not None, timeout):
+                return
+        key = '%s-%d.%d' % ((self.firmware,) + self.firmware_version)
+        layout = read_json(LAYOUT_CACHE_FILE, {}).get(key)
+        if layout:
+            self.setup_layout(layout)
+            return
+        self._capabilities = None
+        self._analog_mapping = None
+        with self.batch():
+            self.send_sysex(CAPABILITY_QUERY)
+            self.send_sysex(ANALOG_MAPPING_QUERY)
+        if not self._wait_for(lambda: self._capabilities is not None and
+                              self._analog_mapping is not None, timeout):
+            return
+        layout = layout_from_capabilities(self._capabilities,
+                                          self._analog_mapping)
+        self.setup_layout(layout)
+        layouts = read_json(LAYOUT_CACHE_FILE, {})
+        layouts[key] = layout
+        try:
+            write_json(LAYOUT_CACHE_FILE, layouts)
+        except (IOError, OSError):
+            pass
+
+    def _wait_for(self, condition, timeout):
+        """
+        Read and handle the data of the board until ``condition()`` is true
+        or ``timeout`` seconds pass. Only for use before the board is read by
+        an :class:`Iterator` or :class:`IOLoop`. Returns True if the
+        condition was met.
+        """
+        cont = time.monotonic() + timeout
+        while not condition():
+            left = cont - time.monotonic()
+            if left <= 0:
+                return False
+            try:
+                ready, _, _ = select.select([self.fileno()], [], [], left)
+            except Exception:
+                # no file descriptor to wait on, poll
+                time.sleep(0.01)
+                ready = True
+            if not ready:
+                continue
+            try:
+                self.iterate()
+            except socket.timeout:
+                # nothing arrived in time
+                pass
+        return True
+
+    def set_analog_calibration(self, pin, points):
+        """
+        Calibrate an analog sensor with a curve of (raw, value) pairs, see
+        :class:`AnalogScale`. Without points the default scale is used.
+        """
+        if points:
+            self._calibrations[pin] = AnalogScale(points)
+        else:
+            self._calibrations.pop(pin, None)
+        if pin < len(self.analog):
+            self.analog[pin].scale = self._calibrations.get(pin,
+                                                            self.analog_scale)
+        self._analog_table = None
+
+    def load_analog_calibration(self, path=CALIBRATION_FILE):
+        """
+        Load the calibration of the analog sensors of this board from a JSON
+        file. It maps the name of each board (see :meth:`get_name`) to the
+        curves of its analog pins, like
+        ``{"MARK0001": {"0": [[0, 0], [900, 1]]}}``, as the sensors of each
+        robot are different.
+        """
+        with open(path) as f:
+            calibrations = json.load(f).get(self.get_name(), {})
+        for pin, points in calibrations.items():
+            self.set_analog_calibration(int(pin), points)
+
+    def _setup_handlers(self):
+        """
+        Build the dispatch tables of this board. ``_command_table`` maps every
+        command byte to a (handler, payload length, has channel) tuple and
+        ``_sysex_table`` maps every sysex command to its handler.
+        """
+        self._command_table = [None] * 256
+        self._sysex_table = [None] * 128
+
         # Setup default handlers for standard incoming commands
-        self.add_cmd_handler(ANALOG_MESSAGE, self._handle_analog_message)
-        self.add_cmd_handler(DIGITAL_MESSAGE, self._handle_digital_message)
-        self.add_cmd_handler(REPORT_VERSION, self._handle_report_version)
+        self.add_cmd_handler(ANALOG_MESSAGE, self._handle_analog_message, 3)
+        self.add_cmd_handler(DIGITAL_MESSAGE, self._handle_digital_message, 3)
+        self.add_cmd_handler(REPORT_VERSION, self._handle_report_version, 2)
         self.add_cmd_handler(REPORT_FIRMWARE, self._handle_report_firmware)
         self.add_cmd_handler(SONAR_DATA, self._handle_sonar_message)
+        self.add_cmd_handler(CAPABILITY_RESPONSE,
+                             self._handle_capability_response)
+        self.add_cmd_handler(ANALOG_MAPPING_RESPONSE,
+                             self._handle_analog_mapping_response)
+
+    def add_cmd_handler(self, cmd, func, bytes_needed=None):
+        """
+        Adds a command handler for a command.
 
-    def add_cmd_handler(self, cmd, func):
-        """Adds a command handler for a command."""
-        len_args = len(inspect.getargspec(func)[0])
-        def add_meta(f):
-            def decorator(*args, **kwargs):
-                f(*args, **kwargs)
-            decorator.bytes_needed = len_args - 1 # exclude self
-            decorator.__name__ = f.__name__
-            return decorator
-        func = add_meta(func)
-        self._command_handlers[cmd] = func
+        :arg cmd: A command byte, or a sysex command for values below 0x80
+        :arg func: The handler, called with the decoded bytes of the message
+        :arg bytes_needed: Number of arguments of ``func``. When not given it
+            is taken from its signature. Unused for sysex commands.
+        """
+        if cmd < 0x80:
+            self._sysex_table[cmd] = func
+            return
+        if bytes_needed is None:
+            bytes_needed = len(inspect.getfullargspec(func).args)
+            if inspect.ismethod(func):
+                bytes_needed -= 1 # exclude self
+        if cmd < START_SYSEX:
+            # The low nibble of these commands is the channel (pin or port)
+            entry = (func, bytes_needed - 1, True)
+            cmd = cmd & 0xF0
+            for i in range(16):
+                self._command_table[cmd + i] = entry
+        else:
+            self._command_table[cmd] = (func, bytes_needed, False)
 
     def pass_time(self, t):
-        """Non-blocking time-out for ``t`` seconds."""
-        cont = time.time() + t
-        while time.time() < cont:
-            time.sleep(0)
+        """
+        Wait ``t`` seconds without using the CPU. To wait for a value from
+        the board use :meth:`Pin.wait_for_update`.
+        """
+        time.sleep(t)
 
     def send_sysex(self, sysex_cmd, data=[]):
         """
@@ -107,18 +296,16 @@ class MarkRobot(object):
         :arg data: A list of 7-bit bytes of arbitrary data (bytes may be
             already converted to chr's)
         """
-        self.sock.write(chr(START_SYSEX))
-        self.sock.write(chr(sysex_cmd))
+        frame = bytearray((START_SYSEX, sysex_cmd))
         for byte in data:
-            try:
-                byte = chr(byte)
-            except TypeError:
-                pass # byte is already a chr
-            except ValueError:
+            if not isinstance(byte, int):
+                byte = ord(byte) # byte is already a chr
+            if byte > 0x7F:
                 raise ValueError('Sysex data can be 7-bit bytes only. '
                     'Consider using utils.to_two_bytes for bigger bytes.')
-            self.sock.write(byte)
-        self.sock.write(chr(END_SYSEX))
+            frame.append(byte)
+        frame.append(END_SYSEX)
+        self._write(frame)
 
 
     def iterate(self):
@@ -126,45 +313,121 @@ class MarkRobot(object):
         Reads and handles data from the microcontroller over the serial port.
         This method should be called in a main loop or in an :class:`Iterator`
         instance to keep this boards pin values up to date.
+
+        Everything the transport has available is drained in a single read
+        and all the complete messages are decoded at once. A message that
+        has only partially arrived is kept until the next call. Raises
+        IOError if the link was closed by the other end.
         """
-        if not(self.sock.inWaiting()):
+        waiting = self.sock.inWaiting()
+        if not waiting:
             return
-        byte = self.sock.read()
-        if not byte:
-            return
-        data = ord(byte)
-        received_data = []
-        handler = None
-        if data < START_SYSEX:
-            # These commands can have 'channel data' like a pin nummber appended.
-            try:
-                handler = self._command_handlers[data & 0xF0]
-            except KeyError:
-                return
-            received_data.append(data & 0x0F)
-            while len(received_data) < handler.bytes_needed:
-                received_data.append(ord(self.sock.read()))
-        elif data == START_SYSEX:
-            data = ord(self.sock.read())
-            handler = self._command_handlers.get(data)
-            if not handler:
-                return
-            data = ord(self.sock.read())
-            while data != END_SYSEX:
-                received_data.append(data)
-                data = ord(self.sock.read())
-        else:
-            try:
-                handler = self._command_handlers[data]
-            except KeyError:
-                return
-            while len(received_data) < handler.bytes_needed:
-                received_data.append(ord(self.sock.read()))
-        # Handle the data
+        data = self.sock.read(waiting)
+        if not data:
+            # the transport had data or was readable, nothing means the
+            # other end closed the link
+            raise IOError('%s closed the connection' % self.get_name())
+        self._rx_buffer.extend(data)
+        if numpy is not None and len(self._rx_buffer) >= BULK_DECODE_MIN_SIZE:
+            self._decode_bulk()
+        self._parse_buffer()
+
+    def _decode_bulk(self):
+        """
+        Decode the analog and sonar frames of a big receive buffer with
+        NumPy and store them pin by pin, leaving the rest of the messages
+        for :meth:`_parse_buffer`.
+        """
+        if self._analog_table is None:
+            # The lookup table of every analog pin, one row per pin
+            self._analog_table = numpy.array(
+                [pin.scale.normalized for pin in self.analog] or
+                [self.analog_scale.normalized])
+        analog, sonar, rest = decode_bulk(self._rx_buffer, time.monotonic(),
+                                          self._analog_table)
+        self._rx_buffer[:] = rest
+        for frames, pins in ((analog, self.analog), (sonar, self.sonar)):
+            for pin_nr in numpy.unique(frames['pin']).tolist():
+                if pin_nr >= len(pins):
+                    continue
+                pin = pins[pin_nr]
+                selected = frames[frames['pin'] == pin_nr]
+                values = selected['scaled']
+                raw = int(selected['raw'][-1])
+                if pins is self.analog:
+                    # Like the handler, analog values only when reporting
+                    if not pin.reporting:
+                        continue
+                    pin._update_values(selected['timestamp'].tobytes(),
+                                       values.tobytes(), float(values[-1]),
+                                       raw)
+                else:
+                    pin._update_values(selected['timestamp'].tobytes(),
+                                       values.tobytes(), raw)
+
+    def _parse_buffer(self):
+        """Decode all the complete messages stored in the receive buffer."""
+        buf = self._rx_buffer
+        command_table = self._command_table
+        size = len(buf)
+        i = 0
         try:
-            handler(*received_data)
-        except ValueError:
-            pass
+            while i < size:
+                data = buf[i]
+                if data < 0x80:
+                    # A data byte without a command, skip until the next
+                    # command
+                    i += 1
+                    continue
+                if data == START_SYSEX:
+                    # the payload is 7 bit, it ends at the first command byte
+                    match = COMMAND_BYTE.search(buf, i + 1)
+                    if match is None:
+                        break
+                    end = match.start()
+                    if buf[end] != END_SYSEX:
+                        # END_SYSEX was lost, drop the frame and resynchronize
+                        # on the new command
+                        i = end
+                        continue
+                    handler = None
+                    if end > i + 1 and buf[i + 1] < 0x80:
+                        handler = self._sysex_table[buf[i + 1]]
+                    received_data = buf[i + 2:end]
+                    i = end + 1
+                    if handler:
+                        try:
+                            handler(*received_data)
+                        except (TypeError, ValueError):
+                            # a frame that lost bytes on the way
+                            pass
+                    continue
+                entry = command_table[data]
+                if entry is None:
+                    i += 1
+                    continue
+                handler, length, channel = entry
+                end = i + 1 + length
+                if end > size:
+                    break
+                payload = buf[i + 1:end]
+                if payload and max(payload) & 0x80:
+                    # The message was cut by a new command, resynchronize
+                    i += 1
+                    continue
+                i = end
+                # Handle the data
+                try:
+                    if channel:
+                        handler(data & 0x0F, *payload)
+                    else:
+                        handler(*payload)
+                except (TypeError, ValueError):
+                    pass
+        finally:
+            # the frames already handled are consumed even if a handler
+            # raised, so a bad frame is never handled again
+            del buf[:i]
 
     def get_firmata_version(self):
         """
@@ -173,6 +436,10 @@ class MarkRobot(object):
         """
         return self.firmata_version
 
+    def fileno(self):
+        """File descriptor of the transport, used to wait for data."""
+        return self.sock.fileno()
+
     def get_name(self):
         if self.sock:
             return self.sock.name
@@ -187,16 +454,23 @@ class MarkRobot(object):
             raise IOError("Pin %s is not a valid servo pin")
         data = itertools.chain([pin], to_two_bytes(min_pulse),
                                         to_two_bytes(max_pulse))
-        self.send_sysex(SERVO_CONFIG, data)
-
-        # set pin._mode to SERVO so that it sends analog messages
-        # don't set pin.mode as that calls this method
-        self.digital[pin]._mode = SERVO
-        self.digital[pin].write(angle)
+        with self.batch():
+            self.send_sysex(SERVO_CONFIG, data)
+
+            # set pin._mode to SERVO so that it sends analog messages
+            # don't set pin.mode as that calls this method
+            self.digital[pin]._mode = SERVO
+            self.digital[pin]._sent_mode = SERVO
+            self.digital[pin]._sent_value = None
+            if self.digital[pin].port:
+                self.digital[pin].port._sent_mask = None
+            self.digital[pin].write(angle)
 
     def sonar_config(self, pin, ping_interval=50, max_distance=200):
         """
-        Configure a distance (sonar) sensor
+        Configure a distance (sonar) sensor. Once configured the board keeps
+        sending its distance every ``ping_interval`` milliseconds and the
+        latest one is in ``self.sonar[pin]``.
         """
         if not(self.sonar[pin]._active):
             if max_distance > 200:
@@ -207,9 +481,115 @@ class MarkRobot(object):
 
             self.sonar[pin]._mode = INPUT
             self.sonar[pin]._active = True
+            self.sonar[pin]._ping_interval = ping_interval
+            self.sonar[pin]._max_distance = max_distance
+            self.sonar[pin].reporting = True
 
             self.send_sysex(SONAR_CONFIG, data)
 
+    def set_sampling_interval(self, interval):
+        """
+        Set the time (in milliseconds) between the reports of the analog pins
+        with a SAMPLING_INTERVAL message.
+        """
+        interval = int(interval)
+        if not(MIN_SAMPLING_INTERVAL <= interval <= MAX_SAMPLING_INTERVAL):
+            raise ValueError('The sampling interval must be from %d to %d ms'
+                             % (MIN_SAMPLING_INTERVAL, MAX_SAMPLING_INTERVAL))
+        self.send_sysex(SAMPLING_INTERVAL, to_two_bytes(interval))
+        self.sampling_interval = interval
+
+    def plan_sampling_interval(self, utilization=LINK_UTILIZATION):
+        """
+        Returns the shortest sampling interval (in milliseconds) that keeps
+        the reports of the enabled pins under ``utilization`` of the
+        bandwidth of the link.
+
+        Each interval a reporting analog pin sends 3 bytes and a reporting
+        digital port up to 3 bytes. Sonars send 6 bytes on their own ping
+        interval, which is taken from the bandwidth first.
+        """
+        per_interval = 0
+        for pin in self.analog:
+            if pin.reporting:
+                per_interval += 3
+        for port in self.digital_ports:
+            if port.reporting:
+                per_interval += 3
+        if not per_interval:
+            return DEFAULT_SAMPLING_INTERVAL
+        budget = self.sock.bandwidth * utilization
+        for pin in self.sonar:
+            if pin._active:
+                budget -= 6 * 1000.0 / pin._ping_interval
+        if budget <= 0:
+            return MAX_SAMPLING_INTERVAL
+        interval = int(math.ceil(per_interval * 1000.0 / budget))
+        return min(max(interval, MIN_SAMPLING_INTERVAL), MAX_SAMPLING_INTERVAL)
+
+    def auto_sampling_interval(self, utilization=LINK_UTILIZATION,
+                               min_interval=DEFAULT_SAMPLING_INTERVAL):
+        """
+        Use the fastest sampling interval that doesn't saturate the link, see
+        :meth:`plan_sampling_interval`, but not under ``min_interval``
+        milliseconds: every report costs host CPU to decode.
+        """
+        interval = max(self.plan_sampling_interval(utilization),
+                       min_interval)
+        if interval != self.sampling_interval:
+            self.set_sampling_interval(interval)
+
+    def snapshot(self):
+        """
+        Returns the state set up on the board: the layout, the sampling
+        interval, the mode and value of the digital pins, the reporting pins
+        and ports and the configured sonars. It can be saved as JSON and
+        given to :meth:`restore` to take over the board after connecting to
+        it again without a reset.
+        """
+        digital = []
+        for pin in self.digital:
+            if pin.mode == UNAVAILABLE:
+                continue
+            if (pin._sent_mode is not None) or (pin.value is not None):
+                digital.append((pin.pin_number, pin.mode, pin.value))
+        return {
+            'layout': self.layout,
+            'sampling_interval': self.sampling_interval,
+            'digital': digital,
+            'analog': [p.pin_number for p in self.analog if p.reporting],
+            'ports': [p.port_number for p in self.digital_ports
+                      if p.reporting],
+            'sonars': [(p.pin_number, p._ping_interval, p._max_distance)
+                       for p in self.sonar if p._active],
+        }
+
+    def restore(self, snapshot):
+        """
+        Replay a :meth:`snapshot` so this object and the board agree again.
+        The board may have kept the state, so the shadow is forgotten first
+        and everything is sent.
+        """
+        self.reset_shadow()
+        with self.batch():
+            interval = snapshot['sampling_interval']
+            if interval != self.sampling_interval:
+                self.set_sampling_interval(interval)
+            for number, mode, value in snapshot['digital']:
+                pin = self.digital[number]
+                if mode == SERVO:
+                    self.servo_config(number, angle=value or 0)
+                    continue
+                pin.mode = mode
+                if (value is not None) and (mode in (OUTPUT, PWM)):
+                    pin.write(value)
+            for number in snapshot['analog']:
+                self.analog[number].enable_reporting()
+            for number in snapshot['ports']:
+                self.digital_ports[number].enable_reporting()
+            for number, ping_interval, max_distance in snapshot['sonars']:
+                self.sonar_config(number, ping_interval, max_distance)
+
     def exit(self):
         """Call this to exit cleanly."""
         # First detach all servo's, otherwise it somehow doesn't want to close...
@@ -222,13 +602,15 @@ class MarkRobot(object):
 
     # Command handlers
     def _handle_analog_message(self, pin_nr, lsb, msb):
-        value = round(float((msb << 7) + lsb) / 1023, 4)
-        # Only set the value if we are actually reporting
         try:
-            if self.analog[pin_nr].reporting:
-                self.analog[pin_nr].value = value
+            pin = self.analog[pin_nr]
         except IndexError:
             raise ValueError
+        # Only set the value if we are actually reporting
+        if pin.reporting:
+            raw = min((msb << 7) + lsb, ANALOG_MAX_RAW)
+            pin.raw = raw
+            pin._update_value(pin.scale.normalized[raw])
 
     def _handle_digital_message(self, port_nr, lsb, msb):
         """
@@ -244,7 +626,7 @@ class MarkRobot(object):
     def _handle_sonar_message(self, pin_nr, lsb, msb):
         mask = (msb << 7) + lsb
         try:
-            self.sonar[pin_nr].value = mask
+            self.sonar[pin_nr]._update_value(mask)
         except IndexError:
             raise ValueError
 
@@ -257,15 +639,46 @@ class MarkRobot(object):
         self.firmware_version = (major, minor)
         self.firmware = two_byte_iter_to_str(data[2:])
 
+    def reset_shadow(self):
+        """
+        Forget the modes, values and port masks known to be on the board, so
+        the next writes are sent even if they look redundant.
+        """
+        for p in self.analog + self.sonar + self.digital:
+            p._sent_mode = None
+            p._sent_value = None
+        for port in self.digital_ports:
+            port._sent_mask = None
+
+    def _handle_capability_response(self, *data):
+        """
+        The modes of each pin as (mode, resolution) pairs, the pins are
+        separated by 0x7F.
+        """
+        capabilities = [[]]
+        i = 0
+        while i < len(data):
+            if data[i] == 0x7F:
+                capabilities.append([])
+                i += 1
+            else:
+                capabilities[-1].append(data[i])
+                i += 2
+        self._capabilities = capabilities[:-1]
+
+    def _handle_analog_mapping_response(self, *data):
+        self._analog_mapping = list(data)
+
     def system_reset(self):
         """
         Send the reset command to the Arduino.
         """
-        data = chr(SYSTEM_RESET)
-        self.sock.write(data)
+        self._write((SYSTEM_RESET,))
+        self.reset_shadow()
         # reset all sonar status
         for p in self.sonar:
             p._active = False
+            p.reporting = False
         for p in self.analog:
             p.type = ANALOG
             p.mode = INPUT
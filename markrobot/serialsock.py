@@ -1,23 +1,102 @@
 
+import errno
+import glob
+import time
 import serial
-import subprocess
+try:
+    from serial.tools import list_ports_linux
+except ImportError:
+    list_ports_linux = None
 from .mark import MarkRobot
+from .util import SERIAL_DEVICE_PATTERNS
+
+# Baud rate of the firmware
+SERIAL_BAUDRATE = 115200
+
+# Seconds DTR is held down to reset the board
+SERIAL_RESET_PULSE = 0.1
+
+# USB (vendor id, product id) of the Arduino boards of the Mark and of the
+# USB-serial chips of the usual clones
+MARK_USB_IDS = set([
+    (0x2341, 0x0043),   # Arduino Uno
+    (0x2341, 0x0001),   # Arduino Uno (first boards)
+    (0x2A03, 0x0043),   # Arduino Uno (arduino.org)
+    (0x1A86, 0x7523),   # CH340
+    (0x0403, 0x6001),   # FTDI FT232R
+    (0x10C4, 0xEA60),   # Silicon Labs CP210x
+])
+
+# Words in the USB product or manufacturer name of a board, lowercase
+MARK_USB_KEYWORDS = ('arduino', 'mark')
 
 class SerialSock(object):
 
     def __init__(self, port):
         self.port = port
+        self.address = port
         self.name = port
         self.sock = None
         self.type = 'serial'
+        # connect() resets the Arduino, reconnect() doesn't
+        self.resets_on_connect = True
+        # bytes per second, 10 bits per byte with start and stop bits
+        self.bandwidth = SERIAL_BAUDRATE / 10.0
 
     def connect(self):
-        self.sock = serial.Serial(self.port, 115200)
-        return MarkRobot(self)
+        self.resets_on_connect = True
+        self._open()
+        try:
+            self._reset()
+            return MarkRobot(self)
+        except:
+            self.close()
+            raise
+
+    def reconnect(self, snapshot):
+        """
+        Connect to a board that is still running since the port was closed,
+        without resetting it, and restore the state saved with
+        MarkRobot.snapshot().
+        """
+        self.resets_on_connect = False
+        self._open()
+        try:
+            board = MarkRobot(self, layout=snapshot['layout'])
+            board.restore(snapshot)
+            return board
+        except:
+            self.close()
+            raise
+
+    def _open(self):
+        self.sock = serial.Serial()
+        self.sock.port = self.port
+        self.sock.baudrate = SERIAL_BAUDRATE
+        # keep DTR up when the port is closed, so the board is not reset
+        # when it is opened again (see reconnect)
+        self.sock.hupcl = False
+        self.sock.open()
+
+    def _reset(self):
+        """
+        Reset the Arduino with a pulse on DTR. Opening the port doesn't do it
+        when DTR was kept up since the last time (see reconnect).
+        """
+        try:
+            self.sock.dtr = False
+            time.sleep(SERIAL_RESET_PULSE)
+            self.sock.dtr = True
+        except IOError as e:
+            # ports without modem lines can't reset the board
+            if e.errno not in (errno.EINVAL, errno.ENOTTY):
+                raise
+        self.sock.reset_input_buffer()
 
     def close(self):
-        self.sock.close()
-        self.sock = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
 
     def inWaiting(self):
         if self.sock:
@@ -27,30 +106,39 @@ class SerialSock(object):
     def write(self, data):
         self.sock.write(data)
 
-    def read(self):
-        return self.sock.read()
-        
+    def read(self, size=1):
+        return self.sock.read(size)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+def is_mark_port(info):
+    """
+    True if a port of serial.tools.list_ports looks like a board: its USB
+    ids are known or its product or manufacturer name has a keyword.
+    """
+    if (info.vid, info.pid) in MARK_USB_IDS:
+        return True
+    for text in (info.product, info.manufacturer):
+        if text:
+            text = text.lower()
+            for keyword in MARK_USB_KEYWORDS:
+                if keyword in text:
+                    return True
+    return False
 
 def find_serial_marks(host=None, name=None):
+    if list_ports_linux is None:
+        # without the details of the ports any USB-serial one can be a board
+        devices = []
+        for pattern in SERIAL_DEVICE_PATTERNS:
+            devices.extend(glob.glob(pattern))
+    else:
+        devices = [info.device for info in list_ports_linux.comports()
+                   if is_mark_port(info)]
     ret = []
-    output_usb_parsed = []
-    output_acm_parsed = []
-    try:
-        output_usb = subprocess.check_output('ls /dev/ | grep ttyUSB', shell=True)
-        output_usb = output_usb.decode()
-        output_usb_parsed = output_usb.split('\n')
-    except:
-        pass
-    try:
-        output_acm = subprocess.check_output('ls /dev/ | grep ttyACM', shell=True)
-        output_acm = output_acm.decode()
-        output_acm_parsed = output_acm.split('\n')
-    except:
-        pass
-    output = output_usb_parsed
-    output.extend(output_acm_parsed)
-    for dev in output:
-        if not(dev == ''):
-             ret.append(SerialSock('/dev/%s' % dev))
+    for dev in sorted(devices):
+        if name is None or name == dev:
+            ret.append(SerialSock(dev))
     return ret
-
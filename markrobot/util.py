@@ -1,3 +1,7 @@
+import json
+import os
+import selectors
+from array import array
 import threading
 import time
 
@@ -24,6 +28,11 @@ QUERY_FIRMWARE = 0x79       # query the firmware name
 SONAR_CONFIG = 0x62  # configure pins to control a Ping type sonar distance device
 SONAR_DATA = 0x63  # distance data returned
 
+ANALOG_MAPPING_QUERY = 0x69     # ask for mapping of analog to pin numbers
+ANALOG_MAPPING_RESPONSE = 0x6A  # reply with mapping info
+CAPABILITY_QUERY = 0x6B         # ask for supported modes and resolution of all pins
+CAPABILITY_RESPONSE = 0x6C      # reply with supported modes and resolution
+
 SERVO_CONFIG = 0x70         # set max angle, minPulse, maxPulse, freq
 STRING_DATA = 0x71          # a string message with 14-bits per char
 SHIFT_DATA = 0x75           # a bitstream to/from a shift register
@@ -50,26 +59,459 @@ SONAR = 0x0b       # Any pin in SONAR mode
 DIGITAL = OUTPUT   # same as OUTPUT below
 # ANALOG is already defined above
 
-# Time to wait after initializing serial, used in Board.__init__
+# Longest wait (in seconds) for the firmware to report its version after
+# connecting, used by MarkRobot.handshake
 BOARD_SETUP_WAIT_TIME = 5
 
+# Time (in seconds) an Arduino takes to boot after the reset done when its
+# serial port is opened. Its version is only asked after that, not to
+# disturb the bootloader
+BOARD_BOOT_TIME = 2
+
+# Longest time an Iterator waits for data before checking if it must stop
+ITERATOR_WAIT_TIMEOUT = 0.5
+
+# Max bytes read at once from transports that can't report pending bytes
+READ_CHUNK_SIZE = 1024
+
+# Sampling interval (in milliseconds) of the firmware until it is changed,
+# and the limits of the SAMPLING_INTERVAL message
+DEFAULT_SAMPLING_INTERVAL = 19
+MIN_SAMPLING_INTERVAL = 1
+MAX_SAMPLING_INTERVAL = 0x3FFF
+
+# Part of the bandwidth of a link that the reports of the board may use
+LINK_UTILIZATION = 0.5
+
+# Max raw value of an analog pin (10 bits)
+ANALOG_MAX_RAW = 1023
+
+# Directory where the library keeps its files
+DATA_PATH = os.path.join(os.path.expanduser('~'), '.mark')
+
+# Calibration of the analog sensors of each board, see
+# MarkRobot.load_analog_calibration
+CALIBRATION_FILE = os.path.join(DATA_PATH, 'calibration.json')
+
+# Board layouts found with capability queries, by firmware and version
+LAYOUT_CACHE_FILE = os.path.join(DATA_PATH, 'layouts.json')
+
+# Bluetooth boards connected before, by name, see bluesock.cached_blue_marks
+BLUETOOTH_CACHE_FILE = os.path.join(DATA_PATH, 'bluetooth.json')
+
+# Seconds a Bluetooth board connected before is tried without an inquiry
+BLUETOOTH_CACHE_TTL = 7 * 24 * 3600
+
+# Longest wait (in seconds) for each answer when probing the board layout
+LAYOUT_QUERY_TIMEOUT = 2
+
+# Longest time (in seconds) to connect to a board, from opening the link to
+# the end of the handshake
+CONNECT_TIMEOUT = 15
+
+# Boards connected at the same time
+CONNECT_WORKERS = 8
+
+# Events of a discovery.SerialWatcher
+SERIAL_ADDED = 'added'
+SERIAL_REMOVED = 'removed'
+
+# Device nodes of the USB-serial ports, as glob patterns
+SERIAL_DEVICE_PATTERNS = ('/dev/ttyUSB*', '/dev/ttyACM*')
+
+# Seconds between two scans of /dev when inotify is not available
+SERIAL_WATCH_INTERVAL = 1
+
+# Seconds a new serial port is left to udev (to set its permissions) before
+# it is reported
+SERIAL_SETTLE_TIME = 0.5
+
+# Layout of the Arduino Uno used by the Mark, until the board tells its own
+DEFAULT_LAYOUT = {
+    'digital' : tuple(x for x in range(14)),
+    'analog' : tuple(x for x in range(6)),
+    'analog_pins' : tuple(x + 14 for x in range(6)),
+    'pwm' : (3, 5, 6, 9, 10, 11),
+    'use_ports' : True,
+    'disabled' : (0, 1) # Rx, Tx, Crystal
+}
+
+# Samples kept by the ring buffer of each pin
+SAMPLE_BUFFER_SIZE = 256
+
+# Link health states
+LINK_HEALTHY = 'healthy'
+LINK_DEGRADED = 'degraded'
+LINK_DISCONNECTED = 'disconnected'
+
+# Errors in a row before a link is considered disconnected
+LINK_MAX_ERRORS = 5
+
+# Seconds to wait after the first error on a link, doubled on each new error
+# up to LINK_BACKOFF_MAX
+LINK_BACKOFF_MIN = 0.01
+LINK_BACKOFF_MAX = 5
+
+
+class AnalogScale(object):
+    """
+    Lookup tables from the raw value of an analog pin to its value from 0.0
+    to 1.0 (``normalized``) and to the 0-100 gray scale (``gray``).
+
+    :arg points: Optional calibration curve, a list of (raw, value) pairs
+        that is linearly interpolated. By default value is raw / 1023.
+    """
+    def __init__(self, points=None):
+        if points:
+            points = sorted((int(r), float(v)) for r, v in points)
+            normalized = [self._interpolate(points, raw)
+                          for raw in range(ANALOG_MAX_RAW + 1)]
+        else:
+            normalized = [float(raw) / ANALOG_MAX_RAW
+                          for raw in range(ANALOG_MAX_RAW + 1)]
+        self.normalized = [round(value, 4) for value in normalized]
+        self.gray = [int(value * 100) for value in self.normalized]
+
+    @staticmethod
+    def _interpolate(points, raw):
+        if raw <= points[0][0]:
+            return points[0][1]
+        for (r0, v0), (r1, v1) in zip(points, points[1:]):
+            if raw <= r1:
+                return v0 + (v1 - v0) * (raw - r0) / float(r1 - r0)
+        return points[-1][1]
+
+
+class SampleBuffer(object):
+    """
+    Ring buffer with the last ``size`` (timestamp, value) samples of a pin.
+    The storage is allocated once, so appending a sample doesn't allocate.
+    Timestamps come from time.monotonic() and always increase.
+    """
+    def __init__(self, size=SAMPLE_BUFFER_SIZE):
+        self.size = size
+        self.times = array('d', [0.0]) * size
+        self.values = array('d', [0.0]) * size
+        # Total of samples appended, the next one goes to count % size
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, timestamp, value):
+        i = self.count % self.size
+        self.times[i] = timestamp
+        self.values[i] = value
+        self.count += 1
+
+    def extend(self, times, values):
+        """
+        Append many samples at once. ``times`` and ``values`` can be anything
+        array('d', ...) accepts, like the bytes of float64 NumPy arrays.
+        """
+        times = array('d', times)
+        values = array('d', values)
+        n = len(times)
+        if n > self.size:
+            # only the newest samples fit
+            self.count += n - self.size
+            times = times[-self.size:]
+            values = values[-self.size:]
+            n = self.size
+        start = self.count % self.size
+        first = min(n, self.size - start)
+        self.times[start:start + first] = times[:first]
+        self.values[start:start + first] = values[:first]
+        if n > first:
+            self.times[:n - first] = times[first:]
+            self.values[:n - first] = values[first:]
+        self.count += n
+
+    def clear(self):
+        self.count = 0
+
+    def _slice(self, data, n):
+        """The last ``n`` items of ``data`` in order, as a list."""
+        end = self.count % self.size
+        start = end - n
+        if start >= 0:
+            return data[start:end].tolist()
+        return data[start:].tolist() + data[:end].tolist()
+
+    def last(self, n=None):
+        """The last ``n`` samples (all if None), the newest at the end."""
+        length = len(self)
+        if n is None or n > length:
+            n = length
+        if n <= 0:
+            return []
+        return list(zip(self._slice(self.times, n),
+                        self._slice(self.values, n)))
+
+    def since(self, timestamp):
+        """The samples taken at or after ``timestamp``."""
+        # Binary search over the sample numbers still in the buffer
+        first = self.count - len(self)
+        lo, hi = first, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[mid % self.size] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.last(self.count - lo)
+
+    def latest(self):
+        """The newest sample, None if empty."""
+        if not self.count:
+            return None
+        i = (self.count - 1) % self.size
+        return (self.times[i], self.values[i])
+
+    def rate(self):
+        """Samples per second over the buffer, None if it can't be known."""
+        length = len(self)
+        if length < 2:
+            return None
+        newest = self.times[(self.count - 1) % self.size]
+        oldest = self.times[(self.count - length) % self.size]
+        if newest <= oldest:
+            return None
+        return (length - 1) / (newest - oldest)
+
+
+class LinkHealth(object):
+    """
+    Health of the link with a board. The link is degraded after an error and
+    disconnected after LINK_MAX_ERRORS errors in a row, any success makes it
+    healthy again. ``callback`` is called with the new state on each change.
+    """
+    def __init__(self, callback=None):
+        self.state = LINK_HEALTHY
+        self.errors = 0
+        self.callback = callback
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            if self.callback:
+                self.callback(state)
+
+    def success(self):
+        if self.errors:
+            self.errors = 0
+            self._set_state(LINK_HEALTHY)
+
+    def failure(self):
+        """Record an error, returns the seconds to wait before a new try."""
+        self.errors += 1
+        if self.errors >= LINK_MAX_ERRORS:
+            self._set_state(LINK_DISCONNECTED)
+        else:
+            self._set_state(LINK_DEGRADED)
+        return min(LINK_BACKOFF_MIN * 2 ** (self.errors - 1), LINK_BACKOFF_MAX)
+
 
 class Iterator(threading.Thread):
-    def __init__(self, board):
+    """
+    Keep the values of a board up to date. The thread sleeps until the
+    transport has data or :meth:`stop` is called, waking up at least every
+    ``timeout`` seconds. With ``poll`` or for transports without a file
+    descriptor the board is polled every millisecond instead.
+
+    Errors back off exponentially, the state of the link is in ``health``
+    and ``on_health_change`` is called with the board and the new state.
+    """
+    def __init__(self, board, poll=False, timeout=ITERATOR_WAIT_TIMEOUT,
+                 on_health_change=None):
         super(Iterator, self).__init__()
         self.board = board
+        self.poll = poll
+        self.timeout = timeout
+        self.on_health_change = on_health_change
+        self.health = LinkHealth(self._health_changed)
         self._execute = True
+        self._stopped = threading.Event()
+        self._wake_r, self._wake_w = os.pipe()
+
+    def _health_changed(self, state):
+        if self.on_health_change:
+            self.on_health_change(self.board, state)
+
+    def _get_selector(self):
+        if self.poll:
+            return None
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(self.board.fileno(), selectors.EVENT_READ)
+        except Exception:
+            selector.close()
+            return None
+        selector.register(self._wake_r, selectors.EVENT_READ)
+        return selector
 
     def run(self):
+        selector = self._get_selector()
         while self._execute:
             try:
-                self.board.iterate()
-                time.sleep(0.001)
+                if selector is None:
+                    self.board.iterate()
+                    time.sleep(0.001)
+                    continue
+                for key, events in selector.select(self.timeout):
+                    if key.fd != self._wake_r:
+                        self.board.iterate()
             except:
+                self._stopped.wait(self.health.failure())
                 continue
+            self.health.success()
+        if selector is not None:
+            selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def stop(self):
+        self._execute = False
+        self._stopped.set()
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass
+
+
+class IOLoop(threading.Thread):
+    """
+    A single thread that reads the data of all the added boards. It sleeps
+    until one of their transports has bytes available instead of polling.
+
+    A board that fails is not watched until its backoff expires, see
+    :class:`LinkHealth`. ``on_health_change`` is called with the board and
+    the new state of its link.
+    """
+    def __init__(self, on_health_change=None):
+        super(IOLoop, self).__init__()
+        self.daemon = True
+        self.on_health_change = on_health_change
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._health = {}
+        self._retry = {}
+        self._execute = True
+        # Writing to this pipe wakes up the loop to apply changes or stop
+        self._wake_r, self._wake_w = os.pipe()
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+
+    def add(self, board):
+        """Start reading the data of ``board``."""
+        self._request(True, board)
+
+    def remove(self, board):
+        """
+        Stop reading the data of ``board``. Returns once the loop no longer
+        uses it, so the board can be closed right after.
+        """
+        done = self._request(False, board)
+        if self.is_alive() and threading.current_thread() is not self:
+            done.wait(1)
+
+    def get_health(self, board):
+        """State of the link of ``board``, None if it is not in the loop."""
+        health = self._health.get(board)
+        if health is None:
+            return None
+        return health.state
+
+    def _request(self, add, board):
+        done = threading.Event()
+        with self._lock:
+            self._pending.append((add, board, done))
+        self._wake()
+        return done
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass
+
+    def _apply_pending(self):
+        """Register and unregister boards, only done by the loop thread."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for add, board, done in pending:
+            try:
+                if add:
+                    self._health[board] = LinkHealth(
+                        self._health_callback(board))
+                    self._selector.register(board.fileno(),
+                                            selectors.EVENT_READ, board)
+                else:
+                    self._health.pop(board, None)
+                    self._retry.pop(board, None)
+                    for key in list(self._selector.get_map().values()):
+                        if key.data is board:
+                            self._selector.unregister(key.fileobj)
+            except Exception:
+                pass
+            done.set()
+
+    def _health_callback(self, board):
+        def callback(state):
+            if self.on_health_change:
+                self.on_health_change(board, state)
+        return callback
+
+    def _failed(self, board):
+        """Stop watching a board that failed until its backoff expires."""
+        for key in list(self._selector.get_map().values()):
+            if key.data is board:
+                self._selector.unregister(key.fileobj)
+        self._retry[board] = time.monotonic() + self._health[board].failure()
+
+    def _retry_boards(self):
+        """
+        Watch again the boards whose backoff expired. Returns the seconds
+        until the next retry, or None if there is nothing to retry.
+        """
+        if not self._retry:
+            return None
+        now = time.monotonic()
+        for board, when in list(self._retry.items()):
+            if when <= now:
+                del self._retry[board]
+                try:
+                    self._selector.register(board.fileno(),
+                                            selectors.EVENT_READ, board)
+                except Exception:
+                    self._failed(board)
+        if not self._retry:
+            return None
+        return max(0, min(self._retry.values()) - now)
+
+    def run(self):
+        while self._execute:
+            self._apply_pending()
+            timeout = self._retry_boards()
+            for key, events in self._selector.select(timeout):
+                board = key.data
+                if board is None:
+                    os.read(self._wake_r, 1024)
+                    continue
+                try:
+                    board.iterate()
+                except:
+                    self._failed(board)
+                    continue
+                self._health[board].success()
+        self._apply_pending()
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
 
     def stop(self):
         self._execute = False
+        self._wake()
 
 
 class Port(object):
@@ -78,6 +520,8 @@ class Port(object):
         self.board = board
         self.port_number = port_number
         self.reporting = False
+        # Last mask sent to the board, None when unknown
+        self._sent_mask = None
 
         self.pins = []
         for i in range(num_pins):
@@ -90,9 +534,7 @@ class Port(object):
     def enable_reporting(self):
         """Enable reporting of values for the whole port."""
         self.reporting = True
-        msg = chr(REPORT_DIGITAL + self.port_number)
-        msg += chr(1)
-        self.board.sock.write(msg)
+        self.board._write((REPORT_DIGITAL + self.port_number, 1))
         for pin in self.pins:
             if pin.mode == INPUT:
                 pin.reporting = True # TODO Shouldn't this happen at the pin?
@@ -100,9 +542,7 @@ class Port(object):
     def disable_reporting(self):
         """Disable the reporting of the port."""
         self.reporting = False
-        msg = chr(REPORT_DIGITAL + self.port_number)
-        msg += chr(0)
-        self.board.sock.write(msg)
+        self.board._write((REPORT_DIGITAL + self.port_number, 0))
 
     def write(self):
         """Set the output pins of the port to the correct state."""
@@ -112,10 +552,11 @@ class Port(object):
                 if pin.value == 1:
                     pin_nr = pin.pin_number - self.port_number * 8
                     mask |= 1 << pin_nr
-        msg = chr(DIGITAL_MESSAGE + self.port_number)
-        msg += chr(mask % 128)
-        msg += chr(mask >> 7)
-        self.board.sock.write(msg)
+        if mask == self._sent_mask:
+            return
+        self._sent_mask = mask
+        self.board._write((DIGITAL_MESSAGE + self.port_number, mask % 128,
+                           mask >> 7))
 
     def _update(self, mask):
         """Update the values for the pins marked as input with the mask."""
@@ -123,7 +564,7 @@ class Port(object):
             for pin in self.pins:
                 if pin.mode is INPUT:
                     pin_nr = pin.pin_number - self.port_number * 8
-                    pin.value = (mask & (1 << pin_nr)) > 0
+                    pin._update_value((mask & (1 << pin_nr)) > 0)
 
 class Pin(object):
     """A Pin representation"""
@@ -136,10 +577,27 @@ class Pin(object):
         self._mode = (type == DIGITAL and OUTPUT or INPUT)
         self.reporting = False
         self.value = None
+        # time.monotonic() of the last value received from the board
+        self.timestamp = None
+        # Last raw value of an analog pin and its AnalogScale
+        self.raw = None
+        self.scale = None
+        # The last values received from the board
+        self.samples = SampleBuffer()
+        # Notified on each value received, _updates counts them
+        self._updated = threading.Condition()
+        self._updates = 0
         self._active = active
+        # Milliseconds between the measures of a configured sonar
+        self._ping_interval = None
+        self._max_distance = None
+        # Shadow of the board registers: the last mode and the last value
+        # (as sent in the frame) known by the board, None when unknown
+        self._sent_mode = None
+        self._sent_value = None
 
     def __str__(self):
-        type = {ANALOG : 'Analog', DIGITAL : 'Digital'}[self.type]
+        type = {ANALOG : 'Analog', DIGITAL : 'Digital', SONAR : 'Sonar'}[self.type]
         return "%s pin %d" % (type, self.pin_number)
 
     def _set_mode(self, mode):
@@ -155,15 +613,20 @@ class Pin(object):
                 raise IOError("Only digital pins can drive servos! %s is not"
                     "digital." % self)
             self._mode = SERVO
-            self.board.servo_config(self.pin_number)
+            if self._sent_mode != SERVO:
+                self.board.servo_config(self.pin_number)
             return
 
         # Set mode with SET_PIN_MODE message
         self._mode = mode
-        command = chr(SET_PIN_MODE)
-        command += chr(self.pin_number)
-        command += chr(mode)
-        self.board.sock.write(command)
+        if mode != self._sent_mode:
+            self._sent_mode = mode
+            self._sent_value = None
+            if self.port:
+                # the firmware changes the pin level with the mode, so the
+                # mask of the port on the board is not known any more
+                self.port._sent_mask = None
+            self.board._write((SET_PIN_MODE, self.pin_number, mode))
         if mode == INPUT:
             self.enable_reporting()
 
@@ -180,21 +643,22 @@ class Pin(object):
         """Set an input pin to report values."""
         if self.mode is not INPUT:
             raise (IOError, "%s is not an input and can therefore not report" % self)
-        if self.type == ANALOG:
+        if self.type == SONAR:
+            # a configured sonar always streams its data
+            self.reporting = True
+        elif self.type == ANALOG:
             self.reporting = True
-            msg = chr(REPORT_ANALOG + self.pin_number)
-            msg += chr(1)
-            self.board.sock.write(msg)
+            self.board._write((REPORT_ANALOG + self.pin_number, 1))
         else:
             self.port.enable_reporting() # TODO This is not going to work for non-optimized boards like Mega
 
     def disable_reporting(self):
         """Disable the reporting of an input pin."""
-        if self.type == ANALOG:
+        if self.type == SONAR:
+            self.reporting = False
+        elif self.type == ANALOG:
             self.reporting = False
-            msg = chr(REPORT_ANALOG + self.pin_number)
-            msg += chr(0)
-            self.board.sock.write(msg)
+            self.board._write((REPORT_ANALOG + self.pin_number, 0))
         else:
             self.port.disable_reporting() # TODO This is not going to work for non-optimized boards like Mega
 
@@ -208,6 +672,64 @@ class Pin(object):
             raise (IOError, "Cannot read pin %s"% self.__str__())
         return self.value
 
+    def read_gray(self):
+        """
+        Returns the last value of an analog pin in the 0-100 gray scale,
+        None if there is no value yet.
+        """
+        if self.raw is None:
+            return None
+        return self.scale.gray[self.raw]
+
+    def _update_value(self, value):
+        """Store a value received from the board."""
+        with self._updated:
+            self.value = value
+            self.timestamp = time.monotonic()
+            self.samples.append(self.timestamp, value)
+            self._updates += 1
+            self._updated.notify_all()
+
+    def _update_values(self, times, values, value, raw=None):
+        """
+        Store many values received from the board at once, see
+        :meth:`SampleBuffer.extend`. ``value`` is the newest one.
+        """
+        with self._updated:
+            self.raw = raw
+            count = self.samples.count
+            self.samples.extend(times, values)
+            self.value = value
+            self.timestamp = self.samples.latest()[0]
+            self._updates += self.samples.count - count
+            self._updated.notify_all()
+
+    def wait_for_update(self, timeout=None, max_age=None):
+        """
+        Block until the board sends a new value or ``timeout`` seconds pass.
+        Returns True if a new value arrived.
+
+        :arg max_age: Return at once if the current value is not older than
+            this (in seconds).
+        """
+        with self._updated:
+            if max_age is not None:
+                age = self.age()
+                if (age is not None) and (age <= max_age):
+                    return True
+            updates = self._updates
+            return self._updated.wait_for(lambda: self._updates != updates,
+                                          timeout)
+
+    def age(self):
+        """
+        Seconds since the last value was received from the board, None if
+        it never sent one.
+        """
+        if self.timestamp is None:
+            return None
+        return time.monotonic() - self.timestamp
+
     def write(self, value):
         """
         Output a voltage from the pin
@@ -221,28 +743,25 @@ class Pin(object):
             raise (IOError, "%s can not be used through Firmata." % self)
         if self.mode is INPUT:
             raise (IOError, "%s is set up as an INPUT and can therefore not be written to" % self)
-        if value is not self.value:
-            self.value = value
-            if self.mode is OUTPUT:
-                if self.port:
-                    self.port.write()
-                else:
-                    msg = chr(DIGITAL_MESSAGE)
-                    msg += chr(self.pin_number)
-                    msg += chr(value)
-                    self.board.sock.write(msg)
-            elif self.mode is PWM:
-                value = int(round(value * 255))
-                msg = chr(ANALOG_MESSAGE + self.pin_number)
-                msg += chr(value % 128)
-                msg += chr(value >> 7)
-                self.board.sock.write(msg)
-            elif self.mode is SERVO:
-                value = int(value)
-                msg = chr(ANALOG_MESSAGE + self.pin_number)
-                msg += chr(value % 128)
-                msg += chr(value >> 7)
-                self.board.sock.write(msg)
+        self.value = value
+        if self.mode == OUTPUT:
+            if self.port:
+                self.port.write()
+                return
+            value = int(value)
+            frame = (DIGITAL_MESSAGE, self.pin_number, value)
+        elif self.mode == PWM:
+            value = int(round(value * 255))
+            frame = (ANALOG_MESSAGE + self.pin_number, value % 128, value >> 7)
+        elif self.mode == SERVO:
+            value = int(value)
+            frame = (ANALOG_MESSAGE + self.pin_number, value % 128, value >> 7)
+        else:
+            return
+        # Only send what the board doesn't have yet
+        if value != self._sent_value:
+            self._sent_value = value
+            self.board._write(frame)
 
 
 def to_two_bytes(integer):
@@ -371,3 +890,47 @@ def break_to_bytes(value):
                 least = (c, rest)
     return (c, value / c)
 
+def layout_from_capabilities(capabilities, analog_mapping):
+    """
+    Return a board layout from the answers to CAPABILITY_QUERY and
+    ANALOG_MAPPING_QUERY.
+
+    :arg capabilities: A list with the modes supported by each pin
+    :arg analog_mapping: A list with the analog channel of each pin, 127 if
+        it has none
+    """
+    digital = tuple(range(len(capabilities)))
+    analog_pins = {}
+    for pin, channel in enumerate(analog_mapping):
+        if channel != 127:
+            analog_pins[channel] = pin
+    channels = tuple(sorted(analog_pins))
+    return {
+        'digital' : digital,
+        'analog' : channels,
+        'analog_pins' : tuple(analog_pins[c] for c in channels),
+        'pwm' : tuple(p for p in digital if PWM in capabilities[p]),
+        'use_ports' : True,
+        # Rx and Tx are used by Firmata, also pins without any mode
+        'disabled' : tuple(p for p in digital
+                           if p in (0, 1) or not capabilities[p]),
+    }
+
+def read_json(path, default=None):
+    """Return the data in a JSON file, ``default`` if it can't be read."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+def write_json(path, data):
+    """Write ``data`` to a JSON file, creating its directory if needed."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Replace the file at once so readers never see half of it
+    tmp = '%s.%d-%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
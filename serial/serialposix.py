@@ -249,8 +249,20 @@ class Serial(SerialBase, PlatformSpecific):
     Serial port class POSIX implementation. Serial port configuration is
     done with termios and fcntl. Runs on Linux and many other Un*x like
     systems.
+
+    Set ``hupcl`` to False before opening the port to keep DTR and RTS
+    asserted when it is closed, so boards that reset on DTR (like the
+    Arduino) are not reset when the port is opened again.
+
+    Set ``read_ahead`` to a number of bytes to make :meth:`read` take up to
+    that many from the kernel at once and keep the ones not asked for, so
+    the next small reads are served from memory. Those bytes are counted by
+    ``in_waiting``, but they don't make the port readable for ``select``.
     """
 
+    hupcl = True
+    read_ahead = 0
+
     def open(self):
         """\
         Open port with current settings. This may throw a SerialException
@@ -292,6 +304,7 @@ class Serial(SerialBase, PlatformSpecific):
                 pass
             else:
                 raise
+        self._read_buffer = bytearray()
         self.reset_input_buffer()
         self.pipe_abort_read_r, self.pipe_abort_read_w = os.pipe()
         self.pipe_abort_write_r, self.pipe_abort_write_w = os.pipe()
@@ -326,6 +339,8 @@ class Serial(SerialBase, PlatformSpecific):
             raise SerialException("Could not configure port: {}".format(msg))
         # set up raw mode / no echo / binary
         cflag |= (termios.CLOCAL | termios.CREAD)
+        if not self.hupcl:
+            cflag &= ~termios.HUPCL
         lflag &= ~(termios.ICANON | termios.ECHO | termios.ECHOE |
                    termios.ECHOK | termios.ECHONL |
                    termios.ISIG | termios.IEXTEN)  # |termios.ECHOPRT
@@ -465,7 +480,7 @@ class Serial(SerialBase, PlatformSpecific):
         """Return the number of bytes currently in the input buffer."""
         #~ s = fcntl.ioctl(self.fd, termios.FIONREAD, TIOCM_zero_str)
         s = fcntl.ioctl(self.fd, TIOCINQ, TIOCM_zero_str)
-        return struct.unpack('I', s)[0]
+        return struct.unpack('I', s)[0] + len(self._read_buffer)
 
     # select based implementation, proved to work on many systems
     def read(self, size=1):
@@ -476,7 +491,11 @@ class Serial(SerialBase, PlatformSpecific):
         """
         if not self.is_open:
             raise portNotOpenError
-        read = bytearray()
+        # served from the read ahead buffer, see read_ahead
+        read = self._read_buffer[:size]
+        del self._read_buffer[:size]
+        if len(read) == size:
+            return bytes(read)
         timeout = Timeout(self._timeout)
         while len(read) < size:
             try:
@@ -490,7 +509,7 @@ class Serial(SerialBase, PlatformSpecific):
                 # there is nothing to read.
                 if not ready:
                     break   # timeout
-                buf = os.read(self.fd, size - len(read))
+                buf = os.read(self.fd, max(size - len(read), self.read_ahead))
                 # read should always return some data as select reported it was
                 # ready to read when we get to this point.
                 if not buf:
@@ -501,6 +520,9 @@ class Serial(SerialBase, PlatformSpecific):
                         'device reports readiness to read but returned no data '
                         '(device disconnected or multiple access on port?)')
                 read.extend(buf)
+                if len(read) > size:
+                    self._read_buffer.extend(read[size:])
+                    del read[size:]
             except OSError as e:
                 # this is for Python 3.x where select.error is a subclass of
                 # OSError ignore BlockingIOErrors and EINTR. other errors are shown
@@ -593,6 +615,7 @@ class Serial(SerialBase, PlatformSpecific):
         if not self.is_open:
             raise portNotOpenError
         termios.tcflush(self.fd, termios.TCIFLUSH)
+        del self._read_buffer[:]
 
     def reset_output_buffer(self):
         """\
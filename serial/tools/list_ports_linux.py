@@ -13,6 +13,43 @@ import os
 from serial.tools import list_ports_common
 
 
+class _SysFSAttribute(object):
+    """\
+    Non-data descriptor for a sysfs attribute of a device, computed on the
+    first access. The value is memoized in the instance and in the module
+    cache, so the files of a device are read once until it is replugged.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = self.func(obj)
+        obj.__dict__[self.name] = value
+        obj._sysfs_values[self.name] = value
+        return value
+
+
+# device -> (stamp of its sysfs directory, attributes read so far)
+_sysfs_cache = {}
+
+
+def _sysfs_stamp(name):
+    """\
+    Inode and mtime of the sysfs directory of a tty. It is created again
+    when a device is plugged, so a new one means the cache is outdated.
+    """
+    try:
+        st = os.stat('/sys/class/tty/{}'.format(name))
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime)
+
+
 class SysFS(list_ports_common.ListPortInfo):
     """Wrapper for easy sysfs access and device info"""
 
@@ -21,57 +58,124 @@ class SysFS(list_ports_common.ListPortInfo):
         # special handling for links
         if device is not None and os.path.islink(device):
             device = os.path.realpath(device)
-            is_link = True
+            self._is_link = True
         else:
-            is_link = False
+            self._is_link = False
+        self._real_device = device
         self.name = os.path.basename(device)
-        self.usb_device_path = None
-        if os.path.exists('/sys/class/tty/{}/device'.format(self.name)):
-            self.device_path = os.path.realpath('/sys/class/tty/{}/device'.format(self.name))
-            self.subsystem = os.path.basename(os.path.realpath(os.path.join(self.device_path, 'subsystem')))
+        # the attributes are read from sysfs when they are used, remove the
+        # defaults set by ListPortInfo
+        for name in self._sysfs_attributes:
+            self.__dict__.pop(name, None)
+        stamp = _sysfs_stamp(self.name)
+        cached = _sysfs_cache.get(self.device)
+        if cached is not None and cached[0] == stamp:
+            self._sysfs_values = cached[1]
+            self.__dict__.update(self._sysfs_values)
         else:
-            self.device_path = None
-            self.subsystem = None
+            self._sysfs_values = {}
+            _sysfs_cache[self.device] = (stamp, self._sysfs_values)
+
+    @_SysFSAttribute
+    def device_path(self):
+        path = '/sys/class/tty/{}/device'.format(self.name)
+        if os.path.exists(path):
+            return os.path.realpath(path)
+        return None
+
+    @_SysFSAttribute
+    def subsystem(self):
+        if self.device_path is None:
+            return None
+        return os.path.basename(os.path.realpath(os.path.join(self.device_path, 'subsystem')))
+
+    @_SysFSAttribute
+    def usb_interface_path(self):
         # check device type
         if self.subsystem == 'usb-serial':
-            self.usb_interface_path = os.path.dirname(self.device_path)
+            return os.path.dirname(self.device_path)
         elif self.subsystem == 'usb':
-            self.usb_interface_path = self.device_path
-        else:
-            self.usb_interface_path = None
-        # fill-in info for USB devices
-        if self.usb_interface_path is not None:
-            self.usb_device_path = os.path.dirname(self.usb_interface_path)
-
-            try:
-                num_if = int(self.read_line(self.usb_device_path, 'bNumInterfaces'))
-            except ValueError:
-                num_if = 1
-
-            self.vid = int(self.read_line(self.usb_device_path, 'idVendor'), 16)
-            self.pid = int(self.read_line(self.usb_device_path, 'idProduct'), 16)
-            self.serial_number = self.read_line(self.usb_device_path, 'serial')
-            if num_if > 1:  # multi interface devices like FT4232
-                self.location = os.path.basename(self.usb_interface_path)
-            else:
-                self.location = os.path.basename(self.usb_device_path)
-
-            self.manufacturer = self.read_line(self.usb_device_path, 'manufacturer')
-            self.product = self.read_line(self.usb_device_path, 'product')
-            self.interface = self.read_line(self.device_path, 'interface')
+            return self.device_path
+        return None
+
+    @_SysFSAttribute
+    def usb_device_path(self):
+        if self.usb_interface_path is None:
+            return None
+        return os.path.dirname(self.usb_interface_path)
 
+    def _read_usb(self, filename, path=None):
+        """Read a file of the USB device, None if it is not one."""
+        if self.usb_device_path is None:
+            return None
+        return self.read_line(path or self.usb_device_path, filename)
+
+    @_SysFSAttribute
+    def vid(self):
+        value = self._read_usb('idVendor')
+        return int(value, 16) if value is not None else None
+
+    @_SysFSAttribute
+    def pid(self):
+        value = self._read_usb('idProduct')
+        return int(value, 16) if value is not None else None
+
+    @_SysFSAttribute
+    def serial_number(self):
+        return self._read_usb('serial')
+
+    @_SysFSAttribute
+    def location(self):
+        if self.usb_device_path is None:
+            return None
+        try:
+            num_if = int(self.read_line(self.usb_device_path, 'bNumInterfaces'))
+        except (TypeError, ValueError):
+            num_if = 1
+        if num_if > 1:  # multi interface devices like FT4232
+            return os.path.basename(self.usb_interface_path)
+        return os.path.basename(self.usb_device_path)
+
+    @_SysFSAttribute
+    def manufacturer(self):
+        return self._read_usb('manufacturer')
+
+    @_SysFSAttribute
+    def product(self):
+        return self._read_usb('product')
+
+    @_SysFSAttribute
+    def interface(self):
+        return self._read_usb('interface', self.device_path)
+
+    @_SysFSAttribute
+    def description(self):
         if self.subsystem in ('usb', 'usb-serial'):
-            self.apply_usb_info()
-        #~ elif self.subsystem in ('pnp', 'amba'):  # PCI based devices, raspi
+            return self.usb_description()
+        elif self.subsystem in ('pnp', 'amba'):  # PCI based devices, raspi
+            return self.name
+        return 'n/a'
+
+    @_SysFSAttribute
+    def hwid(self):
+        if self.subsystem in ('usb', 'usb-serial'):
+            hwid = self.usb_info()
         elif self.subsystem == 'pnp':  # PCI based devices
-            self.description = self.name
-            self.hwid = self.read_line(self.device_path, 'id')
+            hwid = self.read_line(self.device_path, 'id')
         elif self.subsystem == 'amba':  # raspi
-            self.description = self.name
-            self.hwid = os.path.basename(self.device_path)
+            hwid = os.path.basename(self.device_path)
+        elif self._is_link:
+            hwid = 'LINK={}'.format(self._real_device)
+        else:
+            hwid = 'n/a'
+        if self._is_link:
+            hwid += ' LINK={}'.format(self._real_device)
+        return hwid
 
-        if is_link:
-            self.hwid += ' LINK={}'.format(device)
+    _sysfs_attributes = ('device_path', 'subsystem', 'usb_interface_path',
+                         'usb_device_path', 'vid', 'pid', 'serial_number',
+                         'location', 'manufacturer', 'product', 'interface',
+                         'description', 'hwid')
 
     def read_line(self, *args):
         """\